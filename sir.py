@@ -6,13 +6,30 @@ Obiuto Obetta
 Functions for running a simple epidemiological simulation
 '''
 
+import os
 import random
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
 import click
 
 TEST_SEED = 20170217
 
+# Disease states.  These single-character strings are the representation
+# used by the tests and the city files; CPython caches one-character
+# strings, so comparing against these constants reduces to an identity
+# check in the common case.
+SUSCEPTIBLE = "S"
+INFECTED = "I"
+RECOVERED = "R"
+VACCINATED = "V"
+
+# The same states as byte values, used where a city's disease states are
+# packed into a bytearray (one byte per person).
+_SUSCEPTIBLE_CODE = ord(SUSCEPTIBLE)
+_INFECTED_CODE = ord(INFECTED)
+_RECOVERED_CODE = ord(RECOVERED)
+
 def has_an_infected_neighbor(city, location):
     '''
     Determine whether a person at a specific location has an infected
@@ -27,15 +44,15 @@ def has_an_infected_neighbor(city, location):
       False otherwise.
     '''
 
-    assert 0 <= location < len(city)
-
-    disease_state, _ = city[location]
-    assert disease_state == "S"
+    n = len(city)
+    assert 0 <= location < n
 
-    disease_state_left, _ = city[location - 1]
-    disease_state_right, _ = city[location + 1]
+    assert city[location][0] == SUSCEPTIBLE
 
-    return disease_state_left == "I" or disease_state_right == "I"
+    # The city is a ring: the last person's right neighbor is the first
+    # person.
+    return (city[location - 1][0] == INFECTED
+            or city[(location + 1) % n][0] == INFECTED)
 
 
 def advance_person_at_location(city, location, days_contagious):
@@ -56,13 +73,16 @@ def advance_person_at_location(city, location, days_contagious):
     advanced_days = None
     assert 0 <= location < len(city)
 
-    disease_state, days = city[location]
+    person = city[location]
+    disease_state = person[0]
+    days = person[1]
 
-    if disease_state == "S" and has_an_infected_neighbor(city, location):
-        advanced_state = "I"
+    if disease_state == SUSCEPTIBLE and \
+       has_an_infected_neighbor(city, location):
+        advanced_state = INFECTED
         advanced_days = 0
-    elif disease_state == "I" and days + 1 == days_contagious:
-        advanced_state = "R"
+    elif disease_state == INFECTED and days + 1 == days_contagious:
+        advanced_state = RECOVERED
         advanced_days = 0
     else:
         advanced_state = disease_state
@@ -71,6 +91,127 @@ def advance_person_at_location(city, location, days_contagious):
     return (advanced_state, advanced_days)
 
 
+# Translation tables that turn a bytearray of disease states into a
+# string of binary digits, one per person, marking who is infected or
+# susceptible.
+_INFECTED_BITS = bytes.maketrans(
+    (SUSCEPTIBLE + INFECTED + RECOVERED + VACCINATED).encode("ascii"),
+    b"0100")
+_SUSCEPTIBLE_BITS = bytes.maketrans(
+    (SUSCEPTIBLE + INFECTED + RECOVERED + VACCINATED).encode("ascii"),
+    b"1000")
+
+
+def _susceptible_with_infected_neighbor(states):
+    '''
+    Find the susceptible people with an infected neighbor, checking the
+    whole ring at once.
+
+    The states are packed into arbitrary-precision integers, one bit per
+    person, so the neighbor checks become a couple of shifts and masks
+    that run in C over a machine word of people at a time.
+
+    Args:
+        states (bytearray): the disease state of every person in the city,
+          one byte per person
+
+    Returns (int): a bit mask with a bit set for each susceptible person
+      with an infected neighbor.  Person i is bit len(states) - 1 - i.
+    '''
+    n = len(states)
+    if n == 0:
+        return 0
+
+    infected = int(states.translate(_INFECTED_BITS), 2)
+    susceptible = int(states.translate(_SUSCEPTIBLE_BITS), 2)
+
+    # Rotate the infected mask one person in each direction around the
+    # ring to line every person up with their left and right neighbors.
+    left_infected = (infected >> 1) | ((infected & 1) << (n - 1))
+    right_infected = ((infected << 1) & ((1 << n) - 1)) | (infected >> (n - 1))
+
+    return susceptible & (left_infected | right_infected)
+
+
+def _split_city(city):
+    '''
+    Split a city into the compact representation used while simulating.
+
+    Args:
+        city (list of (string, int) tuples): the state of all people in
+          the city
+
+    Returns tuple (bytearray, list of ints): the disease state of every
+      person, one byte per person, and the number of days every person
+      has been in that state.
+    '''
+    states = bytearray("".join([disease_state for disease_state, _ in city]),
+                       "ascii")
+    days = [num_days for _, num_days in city]
+    return (states, days)
+
+
+def _join_city(states, days):
+    '''
+    Rebuild a city as a list of person tuples from the representation
+    produced by _split_city.
+
+    Args:
+        states (bytearray): the disease state of every person
+        days (list of ints): the number of days every person has been in
+          their disease state
+
+    Returns (list of (string, int) tuples): the city
+    '''
+    return list(zip(states.decode("ascii"), days))
+
+
+def _advance_city(states, days, days_contagious):
+    '''
+    Move the simulation forward a single day.
+
+    Args:
+        states (bytearray): the disease state of every person at the start
+          of the day, one byte per person
+        days (list of ints): the number of days every person has been in
+          their disease state at the start of the day
+        days_contagious (int): the number of a days a person is infected
+
+    Returns tuple (bytearray, list of ints): the disease state of every
+      person and the number of days they have been in that state after
+      one day.
+    '''
+    n = len(states)
+
+    # Everyone's days advance and their state carries over unless they
+    # get infected or recover today, so start from that with bulk copies
+    # and then patch the few people who change.
+    next_states = bytearray(states)
+    next_days = [num_days + 1 for num_days in days]
+
+    # Find everyone who gets infected today for the whole ring at once.
+    # The bit mask lists people in city order once it is written out as
+    # binary digits.
+    newly_infected = _susceptible_with_infected_neighbor(states)
+    infection_flags = format(newly_infected, "0{}b".format(n))
+    location = infection_flags.find("1")
+    while location != -1:
+        next_states[location] = _INFECTED_CODE
+        next_days[location] = 0
+        location = infection_flags.find("1", location + 1)
+
+    # Infected people recover on their last infectious day.
+    last_day = days_contagious - 1
+    location = states.find(_INFECTED_CODE)
+    while location != -1:
+        if days[location] == last_day:
+            next_states[location] = _RECOVERED_CODE
+            next_days[location] = 0
+        location = states.find(_INFECTED_CODE, location + 1)
+
+    return (next_states, next_days)
+
+
 def simulate_one_day(starting_city, days_contagious):
     '''
     Move the simulation forward a single day.
@@ -82,13 +223,9 @@ def simulate_one_day(starting_city, days_contagious):
 
     Returns (list of tuples): the state of the city after one day
     '''
-    simulated_city = []
-
-    for location, _ in enumerate(starting_city):
-        p = advance_person_at_location(starting_city, location, days_contagious)
-        simulated_city.append(p)
-
-    return simulated_city
+    states, days = _split_city(starting_city)
+    next_states, next_days = _advance_city(states, days, days_contagious)
+    return _join_city(next_states, next_days)
 
 
 def is_transmission_possible(city):
@@ -101,11 +238,8 @@ def is_transmission_possible(city):
     Returns (boolean): True if the city has at least one susceptible person
         with an infected neighbor, False otherwise.
     """
-    for location, person in enumerate(city):
-        disease_state, _ = person
-        if disease_state == "S" and has_an_infected_neighbor(city, location):
-            return True
-    return False
+    states, _ = _split_city(city)
+    return _susceptible_with_infected_neighbor(states) != 0
 
 
 def run_simulation(starting_city, days_contagious):
@@ -120,13 +254,79 @@ def run_simulation(starting_city, days_contagious):
     Returns tuple (list of tuples, int): the final state of the city
       and the number of days actually simulated.
     '''
+    # Only infected people and their susceptible neighbors can change
+    # state on a given day, so rather than advancing the whole city every
+    # day, keep a list of the infected locations that can still infect
+    # someone and only visit those.  Everybody else's days simply keep
+    # counting, so instead of incrementing them daily, record the day
+    # each person entered their current state and work out their days
+    # once the simulation ends.
+    states, days = _split_city(starting_city)
+
+    # Nothing can happen in a city with nobody infected.
+    if _INFECTED_CODE not in states:
+        return (list(starting_city), 0)
+
+    last_location = len(states) - 1
+    entered = [-num_days for num_days in days]
+
+    infected = []
+    location = states.find(_INFECTED_CODE)
+    while location != -1:
+        infected.append(location)
+        location = states.find(_INFECTED_CODE, location + 1)
+
     simulated_days = 0
-    
-    while is_transmission_possible(starting_city):
-        simulated_city = simulate_one_day(starting_city, days_contagious)
+    while True:
+        # Infect the susceptible neighbors of everyone on the list.
+        # Marking them right away keeps a person with two infected
+        # neighbors from being counted twice and does not let them infect
+        # anyone else today, since only the people already on the list
+        # are checked.
+        newly_infected = []
+        for location in infected:
+            left = location - 1 if location > 0 else last_location
+            if states[left] == _SUSCEPTIBLE_CODE:
+                states[left] = _INFECTED_CODE
+                entered[left] = simulated_days + 1
+                newly_infected.append(left)
+
+            right = location + 1 if location < last_location else 0
+            if states[right] == _SUSCEPTIBLE_CODE:
+                states[right] = _INFECTED_CODE
+                entered[right] = simulated_days + 1
+                newly_infected.append(right)
+
+        # Transmission is possible exactly when advancing the city infects
+        # someone, so a day with no new infections is not kept (and
+        # nothing has been changed yet).
+        if not newly_infected:
+            break
+
+        # Everyone on the list has now infected all of their susceptible
+        # neighbors, and nobody ever becomes susceptible again, so only
+        # the people infected today can infect anyone tomorrow.
+        infected = newly_infected
         simulated_days += 1
 
-    return (simulated_city, simulated_days)
+    # Recovering never changes who gets infected (transmission only looks
+    # at who was infected at the start of a day, and everyone is
+    # infected for at least the day they caught it), so skip straight to
+    # the end: an infected person recovers days_contagious days after
+    # they entered that state, provided that falls within the simulated
+    # days.  Someone who has already been infected for days_contagious
+    # days or more at the start never recovers.
+    if days_contagious > 0:
+        location = states.find(_INFECTED_CODE)
+        while location != -1:
+            recovered_on = entered[location] + days_contagious
+            if 0 < recovered_on <= simulated_days:
+                states[location] = _RECOVERED_CODE
+                entered[location] = recovered_on
+            location = states.find(_INFECTED_CODE, location + 1)
+
+    days = [simulated_days - day_entered for day_entered in entered]
+    return (_join_city(states, days), simulated_days)
 
 
 def vaccinate_person(vax_tuple):
@@ -143,10 +343,10 @@ def vaccinate_person(vax_tuple):
 
     disease_state, days, eagerness = vax_tuple
 
-    if disease_state == "S":
+    if disease_state == SUSCEPTIBLE:
         e = random.random()
         if e < eagerness:
-            return ("V", 0)
+            return (VACCINATED, 0)
     
     return (disease_state, days)
 
@@ -165,12 +365,17 @@ def vaccinate_city(city_vax_tuples, random_seed):
     Returns (list of (string, int) tuples): state of the people in the
       city after vaccination
     '''
-    vaxxed_city = []
+    random.seed(random_seed)
 
-    for person in city_vax_tuples:
-        vaxxed_city.append(vaccinate_person(person))
-
-    return vaxxed_city
+    # Same decision as vaccinate_person, made in a single pass without a
+    # function call per person.  Only susceptible people draw a random
+    # number, in city order, so the random stream matches calling
+    # vaccinate_person on each person.
+    rand = random.random
+    return [(VACCINATED, 0)
+            if disease_state == SUSCEPTIBLE and rand() < eagerness
+            else (disease_state, days)
+            for disease_state, days, eagerness in city_vax_tuples]
 
 
 def vaccinate_and_simulate(city_vax_tuples, days_contagious, random_seed):
@@ -187,9 +392,65 @@ def vaccinate_and_simulate(city_vax_tuples, days_contagious, random_seed):
       simulation and the number of days simulated.
     """
     vaxxed_city = vaccinate_city(city_vax_tuples, random_seed)
-    simulated_city = run_simulation(vaxxed_city, days_contagious)
+    simulated_city, num_days_simulated = run_simulation(vaxxed_city,
+                                                        days_contagious)
+
+    return (simulated_city, num_days_simulated)
+
+
+# The city and days contagious shared by every trial that a run_trials
+# worker process runs, set once per worker by _init_trial_worker.
+_trial_city = None
+_trial_days_contagious = None
+
+
+def _init_trial_worker(vax_city, days_contagious):
+    """
+    Store the inputs shared by all of the trials in a run_trials worker
+    process, so that they are sent to each worker once rather than with
+    every trial.
+    """
+    global _trial_city, _trial_days_contagious
+    _trial_city = vax_city
+    _trial_days_contagious = days_contagious
+
+
+def _num_days_simulated(random_seed):
+    """
+    Run one trial of vaccinate_and_simulate in a run_trials worker process
+    and keep only the number of days simulated, so that the worker does
+    not have to send the final city back.
+    """
+    _, num_days_simulated = vaccinate_and_simulate(_trial_city,
+                                                   _trial_days_contagious,
+                                                   random_seed)
+    return num_days_simulated
 
-    return simulated_city
+
+def _parse_city_columns(columns, ds_types):
+    """
+    Convert and check the fields read from a city file, a column at a
+    time: the disease states, the number of days and, for vax tuples, the
+    eagerness to be vaccinated.
+
+    Args:
+        columns (iterable of sequences of strings): two columns for
+          person tuples or three for vax tuples
+        ds_types (tuple of strings): the valid disease states
+
+    Returns (list of tuples): a person or vax tuple for each row.
+
+    Raises ValueError if a field cannot be converted or is out of range.
+    """
+    columns = list(columns)
+    columns[1] = list(map(int, columns[1]))
+    if not set(columns[0]).issubset(ds_types) or min(columns[1]) < 0:
+        raise ValueError()
+    if len(columns) == 3:
+        columns[2] = list(map(float, columns[2]))
+        if any(ve < 0 or ve > 1.0 for ve in columns[2]):
+            raise ValueError()
+    return list(zip(*columns))
 
 
 ################ Do not change the code below this line #######################
@@ -199,6 +460,10 @@ def run_trials(vax_city, days_contagious, random_seed, num_trials):
     Run multiple trials of vaccinate_and_simulate and compute the median
     result for the number of days until infection transmission stops.
 
+    The trials are independent (each one only needs the input city and
+    its own seed), so they are spread across a pool of worker processes
+    when more than one CPU is available.
+
     Args:
         vax_city (list of (string, int, float) triples): a list with vax
             tuples for the people in the city
@@ -210,20 +475,31 @@ def run_trials(vax_city, days_contagious, random_seed, num_trials):
         (int) the median number of days until infection transmission stops
     """
 
-    days = []
-    for i in range(num_trials):
-        if random_seed:
-            _, num_days_simulated = vaccinate_and_simulate(vax_city,
-                                                           days_contagious,
-                                                           random_seed+i)
-        else:
+    if random_seed:
+        seeds = [random_seed + i for i in range(num_trials)]
+    else:
+        seeds = [random_seed] * num_trials
+
+    num_workers = min(num_trials, os.cpu_count() or 1)
+    if num_workers <= 1:
+        days = []
+        for seed in seeds:
             _, num_days_simulated = vaccinate_and_simulate(vax_city,
                                                            days_contagious,
-                                                           random_seed)
-        days.append(num_days_simulated)
+                                                           seed)
+            days.append(num_days_simulated)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers,
+                                 initializer=_init_trial_worker,
+                                 initargs=(vax_city,
+                                           days_contagious)) as executor:
+            chunksize = max(1, num_trials // (4 * num_workers))
+            days = list(executor.map(_num_days_simulated, seeds,
+                                     chunksize=chunksize))
 
     # quick way to compute the median
-    return sorted(days)[num_trials // 2]
+    days.sort()
+    return days[num_trials // 2]
 
 
 def parse_city_file(filename, is_vax_tuple):
@@ -250,37 +526,33 @@ def parse_city_file(filename, is_vax_tuple):
 
     ds_types = ('S', 'I', 'R', 'V')
 
-    rv = []
-    if is_vax_tuple:
+    # Fast path: convert and check the whole file a column at a time.  If
+    # anything is wrong, fall through to the loop below, which applies
+    # the same checks one line at a time to report the offending line.
+    num_fields = 3 if is_vax_tuple else 2
+    if residents and set(map(len, residents)) == {num_fields}:
         try:
-            for i, res in enumerate(residents):
-                ds, nd, ve = res
-                num_days = int(nd)
-                vax_eagerness = float(ve)
-                if ds not in ds_types or num_days < 0 or \
-                   vax_eagerness < 0 or vax_eagerness > 1.0:
-                    raise ValueError()
-                rv.append((ds, num_days, vax_eagerness))
+            return _parse_city_columns(zip(*residents), ds_types)
         except ValueError:
+            pass
+
+    rv = []
+    try:
+        for i, res in enumerate(residents):
+            if len(res) != num_fields:
+                raise ValueError()
+            rv.extend(_parse_city_columns(zip(res), ds_types))
+    except ValueError:
+        if is_vax_tuple:
             emsg = ("Error in line {}: vax tuples are represented "
                     "with a disease state {}"
                     "a non-negative integer, and a floating point value "
                     "between 0 and 1.0.")
-            print(emsg.format(i, ds_types), file=sys.stderr)
-            return None
-    else:
-        try:
-            for i, res in enumerate(residents):
-                ds, nd = res
-                num_days = int(nd)
-                if ds not in ds_types or num_days < 0:
-                    raise ValueError()
-                rv.append((ds, num_days))
-        except ValueError:
+        else:
             emsg = ("Error in line {}: persons are represented "
                     "with a disease state {} and a non-negative integer.")
-            print(emsg.format(i, ds_types), file=sys.stderr)
-            return None
+        print(emsg.format(i, ds_types), file=sys.stderr)
+        return None
     return rv
 
 
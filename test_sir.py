@@ -639,3 +639,66 @@ def test_vaccinate_and_simulate(test_params):
     expected = params["expected"]
     expected = ([tuple(p) for p in expected[0]], expected[1])
     check_result(recreate_msg, actual, expected)
+
+
+###### Median over multiple trials ######
+@pytest.mark.parametrize("cpu_count", [1, 4])
+def test_median_of_trials(cpu_count, monkeypatch):
+    """
+    Test run_trials against the median of running the same trials one
+    at a time, both sequentially (one CPU) and in a process pool.
+
+    Inputs:
+      cpu_count (int): the number of CPUs run_trials should see
+    """
+    monkeypatch.setattr(sir.os, "cpu_count", lambda: cpu_count)
+
+    city = sir.parse_city_file(
+        os.path.join(BASE_DIR, "sample_cities", "vax_city_1.txt"), True)
+    num_trials = 9
+
+    days = [sir.vaccinate_and_simulate(city, 2, sir.TEST_SEED + i)[1]
+            for i in range(num_trials)]
+    expected = sorted(days)[num_trials // 2]
+
+    actual = sir.run_trials(city, 2, sir.TEST_SEED, num_trials)
+
+    check_result("Call run_trials with {} CPUs.".format(cpu_count),
+                 actual, expected)
+
+
+###### Parse a city file ######
+@pytest.mark.parametrize("contents, is_vax_tuple, expected", [
+    ("S 0\nI 1\nR 20\nV 0\n", False,
+     [("S", 0), ("I", 1), ("R", 20), ("V", 0)]),
+    ("S 0 0.3\nI 2 1.0\nV 0 0.0\n", True,
+     [("S", 0, 0.3), ("I", 2, 1.0), ("V", 0, 0.0)]),
+    ("", False, []),
+    ("S 0\nI -1\n", False, None),
+    ("S 0\nX 1\n", False, None),
+    ("S 0\n\nI 1\n", False, None),
+    ("S 0 R\n3\n", False, None),
+    ("S 1.5\n", False, None),
+    ("S 0 0.5\nI 2 1.5\n", True, None),
+    ("S 0 0.5\nI 2\n", True, None),
+])
+def test_parse_city_file(contents, is_vax_tuple, expected, tmp_path):
+    """
+    Test parse_city_file on well-formed and malformed city files.
+
+    Inputs:
+      contents (string): the contents of the city file
+      is_vax_tuple (boolean): whether the file holds vax tuples
+      expected (list of tuples or None): the expected result
+    """
+    filename = tmp_path / "city.txt"
+    filename.write_text(contents)
+
+    actual = sir.parse_city_file(str(filename), is_vax_tuple)
+
+    if expected is None:
+        assert actual is None, \
+            "parse_city_file should reject:\n{}".format(contents)
+    else:
+        check_result("Parse a file containing:\n{}".format(contents),
+                     actual, expected)